@@ -2,21 +2,30 @@
 package corenlp;
 
 import java.io.*;
+import java.net.InetSocketAddress;
+import java.net.ProtocolFamily;
 import java.net.ServerSocket;
 import java.net.Socket;
+import java.net.SocketAddress;
+import java.net.StandardProtocolFamily;
 import java.nio.ByteBuffer;
+import java.nio.channels.Channels;
+import java.nio.channels.ServerSocketChannel;
+import java.nio.channels.SocketChannel;
 
 import javax.management.RuntimeErrorException;
 
 import org.codehaus.jackson.JsonGenerationException;
 import org.codehaus.jackson.JsonNode;
 import org.codehaus.jackson.map.JsonMappingException;
+import org.codehaus.jackson.node.ArrayNode;
 
 import com.google.common.collect.Lists;
 
 import util.Arr;
 import util.BasicFileIO;
 import util.JsonUtil;
+import util.MsgpackUtil;
 import util.U;
 
 /** 
@@ -29,9 +38,14 @@ import util.U;
  * first field is the command name.  second field is the text of the document as a JSON string.
  * NO NEWLINES ALLOWED IN THE TEXT DATA!  Most JSON libraries escape newlines to \n's so you should be safe.
  * 
+ * To parse a batch of documents in one round trip:
+ *     PARSEDOCS \t ["Hello world.", "Another doc."] \n
+ * the result is a JSON array with one result object per document, in order.
+ * 
  * Output is 
  * 1. big-endian 8-byte integer describing how many bytes the reponse will be.
  * 2. a big-ass JSON object of that length.
+ * With "--wire msgpack" the object is MessagePack-encoded instead of JSON (commands are still JSON).
  * 
  * SOCKETSERVER EXAMPLE
  * in one terminal start the server with e.g.
@@ -44,6 +58,13 @@ import util.U;
 0000020: 4822 2c22 4e4e 222c 222e 225d 2c22 746f  H","NN","."],"to
 
  * note that xxd doesnt read as far as possible so this is an incomplete view.
+ * A socket connection is persistent: the server keeps reading commands from it
+ * (and writing results back, in order) until the client closes it.
+
+ * UNIX DOMAIN SOCKET EXAMPLE (needs Java 16 or later)
+		java -cp "lib/*:/home/sw/corenlp/stanford-corenlp-full-2015-04-20/*" corenlp.SocketServer --unix /tmp/corenlp.sock --configdict '{"annotators": "tokenize, ssplit"}' 
+		echo -e 'PARSEDOC\t"hello world."' | nc -U /tmp/corenlp.sock | xxd
+ * Same protocol as the TCP server, but without the TCP stack or a port number to manage.
 
  * PIPE OUTPUT EXAMPLE
 mkfifo out
@@ -62,10 +83,13 @@ public class SocketServer {
 	JsonPipeline parser;
 	boolean doSocketServer = false;
 	boolean doNamedPipes = false;
+	boolean doUnixSocketServer = false;
 
 	ServerSocket parseServer = null;
 	int port = -1;
 	String outpipeFilename;
+	String unixSocketFilename;
+	boolean msgpackWire = false;
 	
 	public static void main(String[] args) throws Exception {
 		SocketServer runner = new SocketServer();
@@ -77,11 +101,24 @@ public class SocketServer {
 				runner.port = Integer.parseInt(args[1]);
 				args = Arr.subArray(args, 2, args.length);
 			}
+			else if (args[0].equals("--unix")) {
+				runner.doUnixSocketServer = true;
+				runner.unixSocketFilename = args[1];
+				args = Arr.subArray(args, 2, args.length);
+			}
 			else if (args[0].equals("--outpipe")) {
 				runner.doNamedPipes = true;
 				runner.outpipeFilename = args[1];
 				args = Arr.subArray(args, 2, args.length);
 			}
+			else if (args[0].equals("--wire")) {
+				if (args[1].equals("msgpack")) {
+					runner.msgpackWire = true;
+				} else if (!args[1].equals("json")) {
+					throw new RuntimeException("--wire should be json or msgpack, got: " + args[1]);
+				}
+				args = Arr.subArray(args, 2, args.length);
+			}
 			else if (args[0].equals("--configfile")) {
 				log("Using CoreNLP configuration file: " + args[1]);
 				runner.parser.setConfigurationFromFile(args[1]);
@@ -104,6 +141,8 @@ public class SocketServer {
 		
 		if (runner.doSocketServer) {
 			runner.socketServerLoop();
+		} else if (runner.doUnixSocketServer) {
+			runner.unixSocketServerLoop();
 		} else if (runner.doNamedPipes) {
 			runner.namedpipeLoop();
 		} else {
@@ -123,6 +162,13 @@ public class SocketServer {
 			JsonNode input = JsonUtil.parse(inputPayload);
 			String text = input.asText();
 			return parser.processTextDocument(text);
+		case "PARSEDOCS":
+			JsonNode inputs = JsonUtil.parse(inputPayload);
+			ArrayNode results = JsonUtil.om.createArrayNode();
+			for (JsonNode doc : inputs) {
+				results.add(parser.processTextDocument(doc.asText()));
+			}
+			return results;
 		case "CRASH":
 			throw new IOException("fake error");
 		case "PING":
@@ -174,7 +220,7 @@ public class SocketServer {
 		// TODO: undefined behavior if >2GB return value ... which feels pretty possible.
 		// using a long for length here for future-proofing,
 		// but it doesn't help now since byte arrays have max length ~2e9 (Integer.MAX_VALUE or so)
-		byte[] resultToReturn = JsonUtil.om.writeValueAsBytes(result);
+		byte[] resultToReturn = msgpackWire ? MsgpackUtil.toMsgpack(result) : JsonUtil.om.writeValueAsBytes(result);
 		long resultLength = (long) resultToReturn.length;
 		
 		ByteBuffer bb = ByteBuffer.allocate(8);
@@ -187,7 +233,10 @@ public class SocketServer {
 	
 	void initializeSocketServer() {
 		try {
-			parseServer = new ServerSocket(port);
+			parseServer = new ServerSocket();
+			// so a restarted server can rebind while the old port is still in TIME_WAIT
+			parseServer.setReuseAddress(true);
+			parseServer.bind(new InetSocketAddress(port));
 			log("Started socket server on port "+port);
 		} catch (IOException e1) {
 			e1.printStackTrace();
@@ -196,7 +245,6 @@ public class SocketServer {
 	}
 
 	Socket getSocketConnection() throws IOException {
-		// could be smarter here and reuse same socket for multiple commands.
 //		log("sotimeout " + parseServer.getSoTimeout()); // seems to be 0 on both mac and linux, though linux is happy to return null and mac is not
 		Socket clientSocket = parseServer.accept();
 //		System.err.println("Connection Accepted From: "+clientSocket.getInetAddress());
@@ -205,38 +253,87 @@ public class SocketServer {
 	}
 	
 	void socketServerLoop() throws JsonGenerationException, JsonMappingException, IOException {
-		// declare a server socket and a client socket for the server
-		// declare an input and an output stream
-		BufferedReader br;
-		Socket clientSocket = null;
-		String commandstr=null;
-		
 		initializeSocketServer();
 
 		while (true) {
 //			log("Waiting for Connection on Port: "+port);
-			commandstr = null;
+			Socket clientSocket;
 			try {
 				clientSocket = getSocketConnection();
-				br = new BufferedReader(new InputStreamReader(new DataInputStream(clientSocket.getInputStream())));
-				commandstr = br.readLine();
 			} catch (IOException e) {
 				e.printStackTrace();
 				continue;
 			}
-//			log("COMMANDSTR " + commandstr);
-			if (commandstr==null) {
-				// on linux but not mac this seems to happen during startup
-				// when the client isn't actually asking anything but on the server accept() seems to try to get something anyway
+			try {
+				connectionLoop(clientSocket.getInputStream(), clientSocket.getOutputStream());
+			} catch (IOException e) {
+				// client went away in the middle of a command; just wait for the next one.
+				e.printStackTrace();
+			} finally {
+				clientSocket.close();
+			}
+		}
+//		parseServer.close();
+	}
+
+	/*******  unix domain socket server stuff   ***********/
+
+	/**
+	 * UnixDomainSocketAddress and ServerSocketChannel.open(ProtocolFamily) are Java 16+,
+	 * so look them up reflectively; that way the TCP and pipe modes keep working on older JVMs.
+	 */
+	ServerSocketChannel initializeUnixSocketServer() throws Exception {
+		Class<?> addressClass = Class.forName("java.net.UnixDomainSocketAddress");
+		SocketAddress address = (SocketAddress) addressClass.getMethod("of", String.class).invoke(null, unixSocketFilename);
+		ProtocolFamily unix = (ProtocolFamily) Enum.valueOf(StandardProtocolFamily.class, "UNIX");
+		ServerSocketChannel server = (ServerSocketChannel) ServerSocketChannel.class
+				.getMethod("open", ProtocolFamily.class).invoke(null, unix);
+		server.bind(address);
+		new File(unixSocketFilename).deleteOnExit();
+		log("Started unix socket server on "+unixSocketFilename);
+		return server;
+	}
+
+	void unixSocketServerLoop() throws Exception {
+		ServerSocketChannel server = initializeUnixSocketServer();
+
+		while (true) {
+			SocketChannel client;
+			try {
+				client = server.accept();
+			} catch (IOException e) {
+				e.printStackTrace();
 				continue;
 			}
+			try {
+				connectionLoop(Channels.newInputStream(client), Channels.newOutputStream(client));
+			} catch (IOException e) {
+				e.printStackTrace();
+			} finally {
+				client.close();
+			}
+		}
+	}
+
+	/**
+	 * Serve commands from one client connection until it closes.
+	 * The connection is persistent: the client may send any number of
+	 * newline-terminated commands, and gets back one length-prefixed result
+	 * per command, in order.
+	 */
+	void connectionLoop(InputStream instream, OutputStream outstream) throws IOException {
+		BufferedReader br = new BufferedReader(new InputStreamReader(instream, "UTF-8"));
+		BufferedOutputStream out = new BufferedOutputStream(outstream);
+		String commandstr;
+		while ( (commandstr=br.readLine()) != null) {
+//			log("COMMANDSTR " + commandstr);
 			JsonNode result = parseAndRunCommand(commandstr);
 //			log("RESULT " + result);
 			// result could be null.  let's just write it back since the client is waiting.
-			writeResultToStream(result, clientSocket.getOutputStream());
+			writeResultToStream(result, out);
+			out.flush();
 			checkTimings();
 		}
-//		parseServer.close();
 	}
 	
 
@@ -0,0 +1,111 @@
+package util;
+
+import java.io.ByteArrayOutputStream;
+import java.io.DataOutputStream;
+import java.io.IOException;
+import java.util.Iterator;
+
+import org.codehaus.jackson.JsonNode;
+
+/**
+ * Minimal MessagePack encoder for Jackson trees (http://msgpack.org/).
+ * Only handles what JSON can hold -- null, booleans, numbers, strings, arrays, objects --
+ * which is all our results ever contain, so we don't need the msgpack-java dependency.
+ */
+public class MsgpackUtil {
+
+	public static byte[] toMsgpack(JsonNode node) throws IOException {
+		ByteArrayOutputStream bytes = new ByteArrayOutputStream();
+		DataOutputStream out = new DataOutputStream(bytes);
+		write(node, out);
+		out.flush();
+		return bytes.toByteArray();
+	}
+
+	static void write(JsonNode node, DataOutputStream out) throws IOException {
+		if (node == null || node.isNull()) {
+			out.writeByte(0xc0);
+		}
+		else if (node.isBoolean()) {
+			out.writeByte(node.getBooleanValue() ? 0xc3 : 0xc2);
+		}
+		else if (node.isIntegralNumber()) {
+			writeLong(node.getLongValue(), out);
+		}
+		else if (node.isNumber()) {
+			out.writeByte(0xcb);
+			out.writeDouble(node.getDoubleValue());
+		}
+		else if (node.isTextual()) {
+			writeString(node.getTextValue(), out);
+		}
+		else if (node.isArray()) {
+			writeHeader(node.size(), 0x90, 0xdc, 0xdd, out);
+			for (JsonNode x : node) {
+				write(x, out);
+			}
+		}
+		else if (node.isObject()) {
+			writeHeader(node.size(), 0x80, 0xde, 0xdf, out);
+			Iterator<String> names = node.getFieldNames();
+			while (names.hasNext()) {
+				String name = (String) names.next();
+				writeString(name, out);
+				write(node.get(name), out);
+			}
+		}
+		else {
+			throw new IOException("can't convert to msgpack: " + node);
+		}
+	}
+
+	static void writeLong(long v, DataOutputStream out) throws IOException {
+		if (v >= -32 && v < 128) {
+			// positive or negative fixint
+			out.writeByte((int) v);
+		}
+		else if (v >= Integer.MIN_VALUE && v <= Integer.MAX_VALUE) {
+			out.writeByte(0xd2);
+			out.writeInt((int) v);
+		}
+		else {
+			out.writeByte(0xd3);
+			out.writeLong(v);
+		}
+	}
+
+	static void writeString(String s, DataOutputStream out) throws IOException {
+		byte[] b = s.getBytes("UTF-8");
+		if (b.length < 32) {
+			out.writeByte(0xa0 | b.length);
+		}
+		else if (b.length < 256) {
+			out.writeByte(0xd9);
+			out.writeByte(b.length);
+		}
+		else if (b.length < 65536) {
+			out.writeByte(0xda);
+			out.writeShort(b.length);
+		}
+		else {
+			out.writeByte(0xdb);
+			out.writeInt(b.length);
+		}
+		out.write(b);
+	}
+
+	/** array or map header: fix* format for small sizes, else the 16- or 32-bit one */
+	static void writeHeader(int size, int fixBase, int code16, int code32, DataOutputStream out) throws IOException {
+		if (size < 16) {
+			out.writeByte(fixBase | size);
+		}
+		else if (size < 65536) {
+			out.writeByte(code16);
+			out.writeShort(size);
+		}
+		else {
+			out.writeByte(code32);
+			out.writeInt(size);
+		}
+	}
+}
@@ -3,13 +3,34 @@ Client and process monitor for the java socket server.
 """
 
 from __future__ import division
-import subprocess, tempfile, time, os, logging, re, struct, socket, atexit, glob, itertools
+import subprocess, tempfile, time, os, io, errno, logging, re, shlex, struct, socket, select, signal, atexit, glob
+import collections, decimal, threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 from copy import copy,deepcopy
 from pprint import pprint
 try:
     import ujson as json
 except ImportError:
     import json
+try:
+    # For parse_doc(fields=...): stream through big results without building
+    # the parts we don't want.
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    # for CoreNLP(wire='msgpack')
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    # for parse_doc_async.  on python 2 this is the `futures` package.
+    import concurrent.futures as futures
+except ImportError:
+    futures = None
 
 # SUGGESTED: for constituent parsing models, specify shift-reduce parser in
 # configdict with:
@@ -39,44 +60,168 @@ LOG.setLevel("INFO")
 # LOG.setLevel("DEBUG")
 
 PARSEDOC_TIMEOUT_SEC = 60 * 5
+# While waiting for the server to come up, retry after this long at first,
+# doubling the wait up to STARTUP_BUSY_WAIT_INTERVAL_SEC.
+STARTUP_FIRST_WAIT_INTERVAL_SEC = 0.01
 STARTUP_BUSY_WAIT_INTERVAL_SEC = 1.0
+# how long the java process gets to exit on SIGTERM before we SIGKILL it
+SHUTDOWN_TIMEOUT_SEC = 5.0
 
-def command(mode=None, configfile=None, configdict=None, comm_mode=None,
-        java_command="java",
-        java_options="-Xmx4g -XX:ParallelGCThreads=1",
-        **kwargs):
-    d = {}
-    d.update(**locals())
-    d.update(**kwargs)
+# Length prefix on every result from the server.
+# java "long" is 8 bytes, which python struct calls "long long".
+# java default byte ordering is big-endian.
+RESULT_SIZE_STRUCT = struct.Struct('>Q')
+
+# Client socket buffer sizes.  Results can be many MB, so a big receive
+# buffer means fewer, larger recv calls.
+SOCKET_RCVBUF_BYTES = 4 << 20
+SOCKET_SNDBUF_BYTES = 1 << 20
 
-    more_config = ""
+# default for CoreNLP(max_inflight=...): see parse_doc_async
+ASYNC_MAX_INFLIGHT = 16
+
+def command_argv(mode=None, configfile=None, configdict=None, comm_mode=None,
+        classpath=None, server_port=None, outpipe=None, unixsocket=None,
+        wire='json',
+        java_command="java",
+        java_options="-Xmx4g -XX:ParallelGCThreads=1"):
+    """
+    The java server's command line, as an argv list.  It's run directly, not
+    through a shell, so no quoting is needed for the classpath or config.
+    """
     if mode is None and configfile is None and configdict is None:
         assert False, "Need to set mode, or the annotators directly, for this wrapper to work."
     if mode:
         if configdict is not None:
             assert 'annotators' not in configdict, "mode was given but annotators are set in the configdict.  use only one please."
-        elif configdict is None:
-            configdict = {}
-        LOG.info("mode given as '%s' so setting annotators: %s" % (mode, MODES[mode]['annotators']))
-        configdict['annotators'] = MODES[mode]['annotators']
-    if configfile:
-        more_config += " --configfile {}".format(configfile)
-    if configdict:
-        j = json.dumps(configdict)
-        assert "'" not in j, "can't handle single quote in config values"
-        more_config += " --configdict '{}'".format(j)
-    d['more_config'] = more_config
+        # don't modify the caller's dict
+        configdict = dict(configdict or {})
+        annotators = MODES[mode]['annotators']
+        LOG.info("mode given as '%s' so setting annotators: %s" % (mode, annotators))
+        configdict['annotators'] = annotators
 
     if comm_mode=='SOCKET':
-        d['comm_info'] = "--server {server_port}".format(**d)
+        comm_info = ['--server', str(server_port)]
+    elif comm_mode=='UNIX':
+        comm_info = ['--unix', unixsocket]
     elif comm_mode=='PIPE':
-        d['comm_info'] = "--outpipe {outpipe}".format(**d)
-    else: assert False, "need comm_mode to be SOCKET or PIPE but got " + repr(comm_mode)
+        comm_info = ['--outpipe', outpipe]
+    else: assert False, "need comm_mode to be SOCKET, UNIX or PIPE but got " + repr(comm_mode)
+
+    argv = shlex.split(java_command) + shlex.split(java_options)
+    argv += ['-cp', classpath, 'corenlp.SocketServer']
+    argv += comm_info
+    if wire != 'json':
+        argv += ['--wire', wire]
+    if configfile:
+        argv += ['--configfile', configfile]
+    if configdict:
+        argv += ['--configdict', json.dumps(configdict)]
+    return argv
+
+
+# glob results for wildcard classpath entries, shared across CoreNLP instances
+_JAR_GLOB_CACHE = {}
+
+def _existing_jar_files(classpath_entry):
+    """
+    Files that exist for one classpath entry.  Plain paths take a single stat;
+    only entries with wildcards are globbed, and those results are cached.
+    """
+    if not glob.has_magic(classpath_entry):
+        return [classpath_entry] if os.path.exists(classpath_entry) else []
+    if classpath_entry not in _JAR_GLOB_CACHE:
+        matches = glob.glob(classpath_entry)
+        if not matches:
+            # don't remember failures; the jars might get put there later
+            return matches
+        _JAR_GLOB_CACHE[classpath_entry] = matches
+    return _JAR_GLOB_CACHE[classpath_entry]
+
+def _dumps_bytes(obj):
+    """JSON-encode straight to bytes, ready to send to the server."""
+    s = json.dumps(obj)
+    return s if isinstance(s, bytes) else s.encode('utf8')
+
+def _loads(data):
+    """
+    Decode a result buffer (bytearray) from the server.  json and ujson on
+    python 2 only take a str, so this costs one full-size copy.
+    """
+    return json.loads(bytes(data))
+
+class _BufferReader(object):
+    """Read-only file-like view of a buffer, handing out one chunk at a time."""
+    def __init__(self, buf):
+        self.view = memoryview(buf)
+        self.pos = 0
 
+    def read(self, size=-1):
+        end = len(self.view) if size < 0 else self.pos + size
+        chunk = self.view[self.pos:end].tobytes()
+        self.pos += len(chunk)
+        return chunk
 
-    cmd = """exec {java_command} {java_options} -cp '{classpath}' 
-    corenlp.SocketServer {comm_info} {more_config}"""
-    return cmd.format(**d).replace("\n", " ")
+
+def _select_fields(data, fields):
+    """
+    Decode a parse_doc result, keeping only the named fields: per-sentence
+    ones like 'tokens' or 'pos', and top-level ones like 'entities'.  With
+    ijson installed the result is streamed, and the fields we skip never
+    become python objects.  Otherwise it's a full decode then a filter.
+    """
+    fields = set(fields)
+    if ijson is None:
+        return _filter_fields(_loads(data), fields)
+
+    out = {'sentences': []}
+    builder = None
+    try:
+        for prefix, event, value in ijson.parse(_BufferReader(data)):
+            if event == 'number' and isinstance(value, decimal.Decimal):
+                # ijson gives non-integers as Decimal; a full decode gives float
+                value = float(value)
+            if builder is not None:
+                # in the middle of a field we're keeping
+                builder.event(event, value)
+                if event in ('start_map', 'start_array'): depth += 1
+                elif event in ('end_map', 'end_array'): depth -= 1
+                if depth == 0:
+                    target[key] = builder.value
+                    builder = None
+                continue
+            if prefix == '' and event == 'null':
+                return None
+            if prefix == 'sentences.item' and event == 'start_map':
+                out['sentences'].append({})
+                continue
+            if event == 'map_key':
+                continue
+            if prefix.startswith('sentences.item.'):
+                key, target = prefix[len('sentences.item.'):], out['sentences'][-1]
+            elif prefix != 'sentences':
+                key, target = prefix, out
+            else:
+                continue
+            if key not in fields:
+                continue
+            if event in ('start_map', 'start_array'):
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                depth = 1
+            else:
+                target[key] = value
+    except ijson.JSONError as e:
+        raise ValueError(e)
+    return out
+
+
+def _filter_fields(doc, fields):
+    if doc is None: return None
+    out = dict((k, v) for k, v in doc.items() if k in fields and k != 'sentences')
+    out['sentences'] = [dict((k, v) for k, v in sent.items() if k in fields)
+                        for sent in doc['sentences']]
+    return out
 
 
 class SubprocessCrashed(Exception):
@@ -91,8 +236,13 @@ class CoreNLP:
                 "/home/sw/corenlp/stanford-corenlp-full-2015-04-20/*",
                 "/home/sw/stanford-srparser-2014-10-23-models.jar",
                 ),
-            comm_mode='PIPE',  # SOCKET or PIPE
+            comm_mode='PIPE',  # SOCKET, UNIX or PIPE
             server_port=12340, outpipe_filename_prefix="/tmp/corenlp_pywrap_pipe",
+            unixsocket_filename_prefix="/tmp/corenlp_pywrap_sock",
+            max_inflight=ASYNC_MAX_INFLIGHT,
+            wire='json',
+            java_command="java",
+            java_options="-Xmx4g -XX:ParallelGCThreads=1",
             **more_configdict_args
             ):
         """
@@ -115,13 +265,45 @@ class CoreNLP:
         server_port: have to specify this if you want to run multple instances
         in separate processes.  todo we should use some other communication
         mechanism that doesnt have to worry about this
+
+        comm_mode: 'PIPE' (named pipe), 'SOCKET' (TCP on localhost), or
+        'UNIX' (unix domain socket; no port to worry about, and cheaper than
+        TCP, but needs Java 16 or later).
+
+        java_command, java_options: how to run java.
+
+        wire: 'json' (default) or 'msgpack'.  With 'msgpack' the server sends
+        results as MessagePack, which is more compact and faster to decode
+        than JSON; needs the python msgpack library.  raw=True then gives you
+        the msgpack bytes.
+
+        max_inflight: how many commands parse_doc_async lets be outstanding
+        at once before it blocks.
         """
         self.mode = mode
         self.proc = None
         self.server_port = server_port
         self.configfile = configfile
         self.comm_mode = comm_mode
+        self.wire = wire
         self.outpipe = None
+        self.outpipe_fp = None
+        self.unixsocket = None
+        self._sock = None
+        # reused for every result's length prefix
+        self._header_buf = bytearray(RESULT_SIZE_STRUCT.size)
+        self._header_view = memoryview(self._header_buf)
+        # for async commands; see parse_doc_async
+        self._reader = None
+        self._pending = None
+        # reentrant: send_command_async may restart the server, or stop the
+        # reader, while holding it
+        self._send_lock = threading.RLock()
+        self._inflight = threading.BoundedSemaphore(max_inflight)
+
+        assert wire in ('json', 'msgpack'), "wire should be 'json' or 'msgpack', got " + repr(wire)
+        if wire == 'msgpack':
+            assert msgpack is not None, "wire='msgpack' needs the msgpack python library"
 
         self.configdict = deepcopy(configdict)
         if not self.configdict: self.configdict = {}
@@ -132,11 +314,14 @@ class CoreNLP:
             tag = "pypid=%d_time=%s" % (os.getpid(), time.time())
             self.outpipe = "%s_%s" % (outpipe_filename_prefix, tag)
             assert not os.path.exists(self.outpipe)
+        elif self.comm_mode=='UNIX':
+            tag = "pypid=%d_time=%s" % (os.getpid(), time.time())
+            self.unixsocket = "%s_%s" % (unixsocket_filename_prefix, tag)
+            assert not os.path.exists(self.unixsocket)
 
         assert isinstance(corenlp_jars, (list,tuple))
 
-        deglobbed = itertools.chain(*[glob.glob(f) for f in corenlp_jars])
-        assert any(os.path.exists(f) for f in deglobbed), "CoreNLP jar files don't seem to exist; are the paths correct?  Searched files: %s" % repr(deglobbed)
+        assert any(_existing_jar_files(f) for f in corenlp_jars), "CoreNLP jar files don't seem to exist; are the paths correct?  Searched: %s" % repr(list(corenlp_jars))
 
         local_libdir = os.path.join(os.path.abspath(os.path.dirname(__file__)),
                                     'lib')
@@ -148,14 +333,29 @@ class CoreNLP:
 
         # LOG.info("CLASSPATH: " + self.classpath)
 
+        # Worked out once; a restart reuses it.
+        self._command_argv = command_argv(mode=self.mode,
+                configfile=self.configfile, configdict=self.configdict,
+                comm_mode=self.comm_mode, classpath=self.classpath,
+                server_port=self.server_port, outpipe=self.outpipe,
+                unixsocket=self.unixsocket, wire=self.wire,
+                java_command=java_command, java_options=java_options)
+
         self.start_server()
         # This probably is only half-reliable, but worth a shot.
         atexit.register(self.cleanup)
 
     def cleanup(self):
+        # Stop java first: then a PIPE reader thread sees EOF instead of
+        # waiting on results, and stop_reader returns right away.
         self.kill_proc_if_running()
+        self.stop_reader()
+        self.close_socket()
+        self.close_outpipe()
         if self.outpipe and os.path.exists(self.outpipe):
             os.unlink(self.outpipe)
+        if self.unixsocket and os.path.exists(self.unixsocket):
+            os.unlink(self.unixsocket)
 
     def __del__(self):
         # This is also an unreliable way to ensure the subproc is gone, but
@@ -163,38 +363,54 @@ class CoreNLP:
         self.cleanup()
 
     def start_server(self):
+        # java first, as in cleanup
         self.kill_proc_if_running()
+        self.stop_reader()
+        self.close_socket()
 
         if self.comm_mode=='PIPE':
             if not os.path.exists(self.outpipe):
                 os.mkfifo(self.outpipe)
+        elif self.comm_mode=='UNIX':
+            # left behind if the previous server was killed; java can't bind over it.
+            if os.path.exists(self.unixsocket):
+                os.unlink(self.unixsocket)
         
-        cmd = command(**self.__dict__)
-        LOG.info("Starting java subprocess, and waiting for signal it's ready, with command: %s" % cmd)
-        self.proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
-        time.sleep(STARTUP_BUSY_WAIT_INTERVAL_SEC)
+        LOG.info("Starting java subprocess, and waiting for signal it's ready, with command: %s" % ' '.join(self._command_argv))
+        # Own process group (and session), so on shutdown we can signal
+        # everything the JVM is running and not just its main pid.
+        self.proc = subprocess.Popen(self._command_argv, stdin=subprocess.PIPE,
+                close_fds=True, preexec_fn=os.setsid)
 
-        if self.comm_mode=='SOCKET':
-            sock = self.get_socket(num_retries=100, retry_interval=STARTUP_BUSY_WAIT_INTERVAL_SEC)
-            sock.close()
-        elif self.comm_mode=='PIPE':
-            self.outpipe_fp = open(self.outpipe, 'r')
+        if self.comm_mode=='PIPE':
+            # Unbuffered binary file: readinto reads straight into our
+            # buffer, with no buffering or codec layer in between.
+            self.close_outpipe()
+            self.outpipe_fp = io.open(self.outpipe, 'rb', buffering=0)
 
+        retry_interval = STARTUP_FIRST_WAIT_INTERVAL_SEC
         while True:
             # This loop is for if you have timeouts for the socket connection
             # The pipe system doesn't have timeouts, so this should run only
             # once in that case.
+            if self.proc.poll() is not None:
+                raise SubprocessCrashed("java subprocess exited during startup, exit code %s" % self.proc.returncode)
             try:
-                ret = self.send_command_and_parse_result('PING\t""', 2)
+                if self.comm_mode in ('SOCKET', 'UNIX'):
+                    # Connecting is part of the probe.  The connection stays
+                    # open for the first real command to use.
+                    self.get_persistent_socket(num_retries=1)
+                ret = self.send_command_and_parse_result(b'PING\t""', 2)
                 if ret is None:
                     continue
                 assert ret == "PONG", "Bad return data on startup ping: " + ret
                 LOG.info("Successful ping. The server has started.")
                 break
-            except socket.error, e:
+            except socket.error as e:
                 LOG.info("Waiting for startup: ping got exception: %s %s" % (type(e), e))
                 LOG.info("pausing before retry")
-                time.sleep(STARTUP_BUSY_WAIT_INTERVAL_SEC)
+                time.sleep(retry_interval)
+                retry_interval = min(STARTUP_BUSY_WAIT_INTERVAL_SEC, retry_interval * 2)
 
         LOG.info("Subprocess is ready.")
 
@@ -214,43 +430,284 @@ class CoreNLP:
         if retcode is not None:
             LOG.info("Subprocess seems to be stopped, exit code %s" % retcode)
         elif retcode is None:
-            LOG.warning("Killing subprocess %s" % self.proc.pid)
-            os.kill(self.proc.pid, 9)
+            # Ask nicely first, so java can release its socket/pipe, then
+            # reap it so it doesn't linger as a zombie.
+            LOG.warning("Stopping subprocess %s" % self.proc.pid)
+            self.signal_proc(signal.SIGTERM)
+            if self.wait_proc(SHUTDOWN_TIMEOUT_SEC) is None:
+                LOG.warning("Subprocess %s didn't stop, killing it" % self.proc.pid)
+                self.signal_proc(signal.SIGKILL)
+                self.proc.wait()
+
+    def signal_proc(self, sig):
+        # java leads its own process group (see start_server).
+        try:
+            os.killpg(self.proc.pid, sig)
+        except OSError:
+            # already gone
+            pass
+
+    def wait_proc(self, timeout):
+        """Like Popen.wait() but gives up after `timeout` seconds (returning None)."""
+        deadline = time.time() + timeout
+        retcode = self.proc.poll()
+        while retcode is None and time.time() < deadline:
+            time.sleep(0.05)
+            retcode = self.proc.poll()
+        return retcode
+
+    def parse_doc(self, text, timeout=PARSEDOC_TIMEOUT_SEC, raw=False, fields=None):
+        """
+        fields: if you only need some of the output, e.g. ['tokens', 'pos'],
+        give the per-sentence (or top-level, like 'entities') fields here and
+        only those are decoded.  With the ijson library installed, this
+        streams through the result and saves a lot of memory on big outputs
+        like coref, though it's slower in CPU than a full decode.
+        """
+        cmd = b"PARSEDOC\t" + _dumps_bytes(text)
+        return self.send_command_and_parse_result(cmd, timeout, raw=raw, fields=fields)
+
+    def parse_docs(self, texts, timeout=PARSEDOC_TIMEOUT_SEC, raw=False):
+        """
+        Parse a list of documents in one round trip to the server.  Returns a
+        list of results in the same order as `texts` (or None on failure).
 
-    def parse_doc(self, text, timeout=PARSEDOC_TIMEOUT_SEC, raw=False):
-        cmd = "PARSEDOC\t%s" % json.dumps(text)
+        This saves the per-command overhead when you have many small
+        documents.  But the timeout applies to the whole batch, all results
+        are held in memory at once on both sides, and if any document fails
+        the whole batch comes back as None.  So keep batches moderately sized.
+        """
+        cmd = b"PARSEDOCS\t" + _dumps_bytes(list(texts))
         return self.send_command_and_parse_result(cmd, timeout, raw=raw)
 
-    def get_socket(self, num_retries=1, retry_interval=1):
-        # could be smarter here about reusing the same socket?
+    def get_socket(self, num_retries=1, retry_interval=STARTUP_FIRST_WAIT_INTERVAL_SEC):
+        # retry_interval doubles after each failure, up to
+        # STARTUP_BUSY_WAIT_INTERVAL_SEC.
         for trial in range(num_retries):
             try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                # sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # not sure if this is needed?
-                sock.connect(('localhost', self.server_port))
+                if self.comm_mode == 'UNIX':
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    _set_buffer_sizes(sock)
+                    sock.connect(self.unixsocket)
+                else:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    # before connect, so TCP can advertise the bigger window
+                    _set_buffer_sizes(sock)
+                    # We do small-send, then recv ping-pong; don't let Nagle
+                    # hold the command back.
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    # notice a dead java process on an idle connection
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                    sock.connect(('localhost', self.server_port))
                 return sock
             except (socket.error, socket.timeout) as e:
                 LOG.info("socket error when making connection (%s)" % e)
                 if trial < num_retries-1:
                     LOG.info("pausing before retry")
                     time.sleep(retry_interval)
-        assert False, "couldnt connect socket"
+                    retry_interval = min(STARTUP_BUSY_WAIT_INTERVAL_SEC, retry_interval * 2)
+        raise socket.error("couldnt connect socket")
+
+    def get_persistent_socket(self, num_retries=100):
+        """
+        The socket connection we reuse for all commands.  The java server
+        keeps a connection open until we close it, so this saves a connect
+        per document.
+        """
+        if self._sock is None:
+            self._sock = self.get_socket(num_retries=num_retries)
+        return self._sock
+
+    def close_outpipe(self):
+        if self.outpipe_fp is not None:
+            self.outpipe_fp.close()
+            self.outpipe_fp = None
+
+    def close_socket(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except socket.error:
+                pass
+            self._sock = None
 
-    def send_command_and_parse_result(self, cmd, timeout, raw=False):
+    def parse_doc_async(self, text, raw=False, fields=None):
+        """
+        Like parse_doc, but returns right after sending the document, with a
+        concurrent.futures.Future for the result.  So you can keep sending
+        documents while the server works on earlier ones, instead of waiting
+        a full round trip for each.
+
+        A background thread reads the results (the server answers in order)
+        and resolves the futures.  At most `max_inflight` commands can be
+        outstanding; past that, this blocks until a result comes back.  While
+        the thread runs, plain parse_doc calls go through it too.
+        Needs concurrent.futures (on python 2, the `futures` package).
+        """
+        cmd = b"PARSEDOC\t" + _dumps_bytes(text)
+        return self.send_command_async(cmd, raw=raw, fields=fields)
+
+    def parse_pipelined(self, texts, inflight=8, timeout=PARSEDOC_TIMEOUT_SEC, raw=False, fields=None):
+        """
+        Parse an iterable of documents, yielding results in order.  Up to
+        `inflight` documents are sent ahead of the results we've read, over
+        the one connection, so the server never sits idle waiting for our
+        next command (like HTTP pipelining).  No threads involved.
+
+        timeout applies to each result.  If it runs out, socket.timeout is
+        raised (rather than yielding None) since, without the reader thread,
+        the connection is then dropped.  Very large documents with a large `inflight` can fill the
+        OS buffers in both directions and deadlock; parse_doc_async, which
+        reads on its own thread, doesn't have that problem.
+        """
+        self.ensure_proc_is_running()
+        if self._reader is not None:
+            # the reader thread owns the incoming side; go through it
+            window = collections.deque()
+            try:
+                for text in texts:
+                    window.append(self.parse_doc_async(text, raw=raw, fields=fields))
+                    if len(window) >= inflight:
+                        yield window.popleft().result(timeout)
+                while window:
+                    yield window.popleft().result(timeout)
+            except futures.TimeoutError:
+                raise socket.timeout("timed out waiting for result")
+            return
+
+        num_pending = 0
+        finished = False
         try:
-            self.ensure_proc_is_running()
-            data = self.send_command_and_get_string_result(cmd, timeout)
-            if data is None: return None
-            decoded = None
-            if raw:
-                return data
+            for text in texts:
+                deadline = time.time() + timeout if timeout is not None else None
+                self._send_command(b"PARSEDOC\t" + _dumps_bytes(text), deadline)
+                num_pending += 1
+                if num_pending >= inflight:
+                    result = self._read_pipelined_result(timeout, raw, fields)
+                    num_pending -= 1
+                    yield result
+            while num_pending:
+                result = self._read_pipelined_result(timeout, raw, fields)
+                num_pending -= 1
+                yield result
+            finished = True
+        finally:
+            # Stopped early (error, or the caller quit iterating): answers may
+            # still be on their way, or a command only half sent.
+            if not finished and self.comm_mode in ('SOCKET', 'UNIX'):
+                self.close_socket()
+            elif num_pending and self.comm_mode == 'PIPE':
+                for i in range(num_pending):
+                    self._read_result(self.outpipe_fp.readinto)
+
+    def _read_pipelined_result(self, timeout, raw, fields):
+        if self.comm_mode in ('SOCKET', 'UNIX'):
+            deadline = time.time() + timeout if timeout is not None else None
+            readinto = _socket_readinto(self.get_persistent_socket(), deadline)
+        elif self.comm_mode == 'PIPE':
+            readinto = self.outpipe_fp.readinto
+        return _decode_result(self._read_result(readinto), raw, fields, self.wire)
+
+    def send_command_async(self, cmd, raw=False, fields=None):
+        assert futures is not None, "async commands need concurrent.futures (pip install futures on python 2)"
+        self._inflight.acquire()
+        future = futures.Future()
+        queued = False
+        try:
+            with self._send_lock:
+                # under the lock, so two threads that find the server dead
+                # don't both start one
+                self.ensure_proc_is_running()
+                if self._reader is None:
+                    self.start_reader()
+                # queue it before sending, so the reader knows who the answer is for
+                self._pending.put((future, raw, fields))
+                queued = True
+                try:
+                    self._send_command(cmd)
+                except (socket.error, IOError):
+                    # the answers could no longer be matched up with the futures
+                    self.stop_reader()
+                    raise
+        finally:
+            if not queued:
+                # e.g. start_reader couldn't connect; the reader will never
+                # release this slot for us
+                self._inflight.release()
+        return future
+
+    def start_reader(self):
+        # Under the send lock, like stop_reader, so a command is never queued
+        # for a reader that's being swapped out.
+        with self._send_lock:
+            if self.comm_mode in ('SOCKET', 'UNIX'):
+                readinto = _socket_readinto(self.get_persistent_socket(), None)
+            elif self.comm_mode == 'PIPE':
+                readinto = self.outpipe_fp.readinto
+            # A fresh queue per reader thread; a stopped one may still be
+            # draining its own.
+            self._pending = queue.Queue()
+            self._reader = threading.Thread(target=self._reader_loop,
+                    args=(self._pending, readinto), name="CoreNLP_PyWrapper reader")
+            self._reader.daemon = True
+            self._reader.start()
+
+    def stop_reader(self):
+        """
+        Stop the background reader thread, and wait for it to finish.  In
+        SOCKET and UNIX mode the connection is shut down and closed (the next
+        command opens a new one), so outstanding futures fail.  In PIPE mode the thread first reads the results
+        already on their way, and those futures resolve as usual (to None if
+        the server has exited).
+        """
+        with self._send_lock:
+            if self._reader is None:
+                return
+            # nothing can be queued behind this end marker, since senders
+            # hold the lock too
+            self._pending.put(None)
+            if self._sock is not None:
+                # wakes up the reader if it's blocked in recv
+                try:
+                    self._sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            reader, self._reader = self._reader, None
+            # Until it's done, it still owns the incoming side; in PIPE mode
+            # a new reader (or a plain parse_doc) would read its results.
+            if reader is not threading.current_thread():
+                reader.join()
+            self.close_socket()
+
+    def _reader_loop(self, pending, readinto):
+        header_buf = bytearray(RESULT_SIZE_STRUCT.size)
+        header_view = memoryview(header_buf)
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            future, raw, fields = item
+            try:
+                data = self._read_result(readinto, header_buf, header_view)
+                future.set_result(_decode_result(data, raw, fields, self.wire))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self._inflight.release()
+
+    def send_command_and_parse_result(self, cmd, timeout, raw=False, fields=None):
+        if self._reader is not None:
+            # The reader thread owns the incoming side of the connection.
+            future = self.send_command_async(cmd, raw=raw, fields=fields)
             try:
-                decoded = json.loads(data)
-            except ValueError:
-                LOG.warning("Bad JSON returned from subprocess; returning null.")
-                LOG.warning("Bad JSON length %d, starts with: %s" % (len(data), repr(data[:1000])))
+                return future.result(timeout)
+            except futures.TimeoutError:
+                LOG.info("Timeout waiting for result, returning None")
                 return None
-            return decoded
+        try:
+            self.ensure_proc_is_running()
+            data = self.send_command_and_get_string_result(cmd, timeout)
+            return _decode_result(data, raw, fields, self.wire)
         except socket.timeout, e:
             LOG.info("Socket timeout happened, returning None: %s %s" % (type(e), e))
             return None
@@ -260,41 +717,166 @@ class CoreNLP:
             # the process now just in case?
 
     def send_command_and_get_string_result(self, cmd, timeout):
-        if self.comm_mode == 'SOCKET':
-            sock = self.get_socket(num_retries=100)
-            sock.settimeout(timeout)
-            sock.sendall(cmd + "\n")
-            size_info_str = sock.recv(8)
+        if self.comm_mode in ('SOCKET', 'UNIX'):
+            try:
+                return self._socket_command(cmd, timeout)
+            except socket.timeout:
+                # The server is still working on our command and will write
+                # its answer to this connection later; start afresh next time.
+                self.close_socket()
+                raise
+            except socket.error as e:
+                # Connection went stale (e.g. server was restarted).
+                # Reconnect once and retry.
+                LOG.info("socket error on persistent connection, reconnecting (%s)" % e)
+                self.close_socket()
+                try:
+                    return self._socket_command(cmd, timeout)
+                except socket.error:
+                    self.close_socket()
+                    raise
         elif self.comm_mode == 'PIPE':
-            self.proc.stdin.write(cmd + "\n")
+            self._send_command(cmd)
+            return self._read_result(self.outpipe_fp.readinto)
+
+    def _send_command(self, cmd, deadline=None):
+        if self.comm_mode in ('SOCKET', 'UNIX'):
+            if deadline is None:
+                self.get_persistent_socket().sendall(cmd + b"\n")
+            else:
+                _send_before(self.get_persistent_socket(), cmd + b"\n", deadline)
+        elif self.comm_mode == 'PIPE':
+            self.proc.stdin.write(cmd + b"\n")
             self.proc.stdin.flush()
-            size_info_str = self.outpipe_fp.read(8)
 
-        # java "long" is 8 bytes, which python struct calls "long long".
-        # java default byte ordering is big-endian.
-        size_info = struct.unpack('>Q', size_info_str)[0]
+    def _socket_command(self, cmd, timeout):
+        # The timeout is for the whole command, sending and reading.  The
+        # socket itself stays in blocking mode; see _send_before and
+        # _socket_readinto for how each side keeps to the deadline.
+        deadline = time.time() + timeout if timeout is not None else None
+        sock = self.get_persistent_socket()
+        self._send_command(cmd, deadline)
+        return self._read_result(_socket_readinto(sock, deadline))
+
+    def _read_result(self, readinto, header_buf=None, header_view=None):
+        """
+        Reads the length-prefixed result into one preallocated buffer and
+        returns it (a bytearray).  readinto(view) must block until it can fill
+        some of the view, and return the number of bytes read (0 at EOF).
+        """
+        if header_buf is None:
+            header_buf, header_view = self._header_buf, self._header_view
+        if not _readinto_fully(header_view, readinto):
+            LOG.warning("Incomplete length header from server")
+            return None
+        size_info = RESULT_SIZE_STRUCT.unpack_from(header_buf)[0]
         # print "size expected", size_info
 
-        chunks = []
-        curlen = lambda: sum(len(x) for x in chunks)
-        while True:
-            remaining_size = size_info - curlen()
-            if self.comm_mode == 'SOCKET':
-                data = sock.recv(remaining_size)
-            elif self.comm_mode == 'PIPE':
-                data = self.outpipe_fp.read(remaining_size)
-            chunks.append(data)
-            if curlen() >= size_info: break
-            if len(chunks) > 1000:
-                LOG.warning("Incomplete value from server")
-                return None
-            time.sleep(0.01)
-        return ''.join(chunks)
+        buf = bytearray(size_info)
+        if not _readinto_fully(memoryview(buf), readinto):
+            LOG.warning("Incomplete value from server")
+            return None
+        return buf
+
+
+def _set_buffer_sizes(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RCVBUF_BYTES)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_SNDBUF_BYTES)
+
+def _set_recv_timeout(sock, timeout):
+    """SO_RCVTIMEO on a blocking socket; 0 means no timeout."""
+    sec = int(timeout)
+    usec = int((timeout - sec) * 1e6)
+    if timeout > 0 and not (sec or usec):
+        # a zero timeval would mean no timeout at all
+        usec = 1
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack('ll', sec, usec))
+
+def _socket_readinto(sock, deadline):
+    """
+    readinto for _read_result on a blocking socket.  Each recv uses
+    MSG_WAITALL, so the header and the body normally come in one recv each.
+    With a deadline, SO_RCVTIMEO is set to what's left of it before each
+    recv; when that runs out the kernel hands back what has arrived (or
+    EAGAIN if nothing has), and the next call raises socket.timeout.
+    """
+    if deadline is None:
+        # clear whatever an earlier command left
+        _set_recv_timeout(sock, 0)
+    def recv_into(view):
+        if deadline is not None:
+            remaining_time = deadline - time.time()
+            if remaining_time <= 0:
+                raise socket.timeout("timed out reading result")
+            _set_recv_timeout(sock, remaining_time)
+        try:
+            n = sock.recv_into(view, 0, socket.MSG_WAITALL)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise socket.timeout("timed out reading result")
+            raise
+        if not n:
+            raise socket.error("connection closed by server")
+        return n
+    return recv_into
+
+def _send_before(sock, data, deadline):
+    """
+    sendall that gives up at the deadline, raising socket.timeout.  Waits in
+    poll until the socket can take more, then sends without blocking, so a
+    server that has stopped reading can't hold us past the deadline.
+    """
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        remaining_time = deadline - time.time()
+        if remaining_time <= 0 or not _wait_writable(sock, remaining_time):
+            raise socket.timeout("timed out sending command")
+        offset += sock.send(view[offset:], socket.MSG_DONTWAIT)
+
+def _wait_writable(sock, timeout):
+    """Wait up to `timeout` seconds for sock to take more data.  False if it didn't."""
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT)
+        return bool(poller.poll(timeout * 1000))
+    return bool(select.select([], [sock], [], timeout)[1])
+
+def _decode_result(data, raw=False, fields=None, wire='json'):
+    if data is None: return None
+    if raw:
+        return bytes(data)
+    if wire == 'msgpack':
+        try:
+            doc = msgpack.unpackb(data, raw=False)
+        except ValueError:
+            LOG.warning("Bad msgpack data returned from subprocess; returning null.")
+            return None
+        return _filter_fields(doc, set(fields)) if fields is not None else doc
+    try:
+        if fields is not None:
+            return _select_fields(data, fields)
+        return _loads(data)
+    except ValueError:
+        LOG.warning("Bad JSON returned from subprocess; returning null.")
+        LOG.warning("Bad JSON length %d, starts with: %s" % (len(data), repr(bytes(data[:1000]))))
+        return None
+
+def _readinto_fully(view, readinto):
+    """Fill the whole view, resuming after short reads.  False on EOF."""
+    offset = 0
+    while offset < len(view):
+        n = readinto(view[offset:])
+        if not n:
+            return False
+        offset += n
+    return True
 
 
 def test_modes():
     import pytest
     gosimple(comm_mode='SOCKET')
+    gosimple(comm_mode='UNIX')
     gosimple(comm_mode='PIPE')
     with pytest.raises(AssertionError):
         gosimple(comm_mode=None)
@@ -308,6 +890,7 @@ def test_coref():
     pprint(ret)
     assert 'entities' in ret
     assert isinstance(ret['entities'], list)
+    p.kill_proc_if_running()
 
 def gosimple(**kwargs):
     assert_no_java("no java when starting")
@@ -321,6 +904,147 @@ def gosimple(**kwargs):
     p.kill_proc_if_running()
     assert_no_java()
 
+def test_msgpack_wire():
+    import pytest
+    gosimple(wire='msgpack')
+    # same result as over JSON
+    text = "Hello world. Hi there."
+    results = []
+    for wire in ('json', 'msgpack'):
+        p = CoreNLP("ssplit", wire=wire)
+        results.append(p.parse_doc(text))
+        p.kill_proc_if_running()
+    assert results[0] == results[1]
+    with pytest.raises(AssertionError):
+        CoreNLP("ssplit", wire='asdfasdf')
+    assert_no_java()
+
+def test_parse_docs():
+    assert_no_java("no java when starting")
+    p = CoreNLP("ssplit")
+    ret = p.parse_docs(["Hello world.", "Hi. There."])
+    assert [len(r['sentences']) for r in ret] == [1, 2]
+    p.kill_proc_if_running()
+    assert_no_java()
+
+def test_parse_doc_async():
+    for comm_mode in ('SOCKET', 'UNIX', 'PIPE'):
+        assert_no_java("no java when starting")
+        p = CoreNLP("ssplit", comm_mode=comm_mode)
+        texts = ["Hello world.", "Hi. There.", "One. Two. Three."] * 5
+        results = [p.parse_doc_async(text) for text in texts]
+        assert [len(f.result()['sentences']) for f in results] == [1, 2, 3] * 5
+        # while the reader thread runs, parse_doc goes through it
+        ret = p.parse_doc("Hello world.")
+        assert u' '.join(ret['sentences'][0]['tokens']) == u"Hello world ."
+        big = u' '.join([u'w'] * 300000) + u'.'
+        try:
+            list(p.parse_pipelined([big], timeout=0.01))
+            assert False, "should have timed out"
+        except socket.timeout:
+            pass
+        p.stop_reader()
+        assert [len(r['sentences']) for r in p.parse_pipelined(texts[:3])] == [1, 2, 3]
+        if comm_mode != 'PIPE':
+            # a connection that broke on the first send is replaced next time
+            p._sock.shutdown(socket.SHUT_RDWR)
+            try:
+                list(p.parse_pipelined(texts[:3]))
+                assert False, "should have failed"
+            except socket.error:
+                pass
+            assert [len(r['sentences']) for r in p.parse_pipelined(texts[:3])] == [1, 2, 3]
+        ret = p.parse_doc("Hi. There.")
+        assert len(ret['sentences']) == 2
+        p.kill_proc_if_running()
+        assert_no_java()
+
+def test_chunked_read():
+    # results often arrive a few KB per read; each read should just advance
+    # an offset into the one buffer.
+    payload = b"x" * 1000003
+    src = io.BytesIO(payload)
+    calls = [0]
+    def readinto(view):
+        calls[0] += 1
+        chunk = src.read(min(len(view), 4096))
+        view[:len(chunk)] = chunk
+        return len(chunk)
+    buf = bytearray(len(payload))
+    assert _readinto_fully(memoryview(buf), readinto)
+    assert bytes(buf) == payload
+    assert calls[0] == len(payload) // 4096 + 1
+    # EOF before the buffer is full
+    assert not _readinto_fully(memoryview(bytearray(10)), readinto)
+
+def test_select_fields():
+    # streaming through the result with ijson should give what a full
+    # decode then filter does
+    sample = {
+        'sentences': [
+            {'tokens': ['I', 'saw', 'Fred', '.'], 'pos': ['PRP', 'VBD', 'NNP', '.'],
+             'char_offsets': [[0, 1], [2, 5], [6, 10], [10, 11]],
+             'deps_basic': [['nsubj', 1, 0], ['dobj', 1, 2], ['punct', 1, 3]],
+             'deps_cc': [['nsubj', 1, 0], ['dobj', 1, 2]],
+             'parse': "(ROOT (S (NP (PRP I)) (VP (VBD saw) (NP (NNP Fred))) (. .)))"},
+            {'tokens': ['He', 'left', '.'], 'pos': ['PRP', 'VBD', '.'],
+             'char_offsets': [[12, 14], [15, 19], [19, 20]],
+             'deps_basic': [], 'deps_cc': [['nsubj', 1, 0]],
+             'parse': "(ROOT (S (NP (PRP He)) (VP (VBD left)) (. .)))"},
+        ],
+        'entities': [
+            {'entityid': 1, 'mentions': [{'sentence': 0, 'tokspan_in_sentence': [2, 3], 'head': 2},
+                                         {'sentence': 1, 'tokspan_in_sentence': [0, 1], 'head': 0}]},
+        ],
+        'score': 0.25,
+    }
+    data = bytearray(_dumps_bytes(sample))
+    for fields in (['tokens'], ['tokens', 'pos'], ['deps_basic', 'deps_cc'],
+                   ['char_offsets', 'entities'], ['parse', 'score'], ['nothere']):
+        assert _select_fields(data, fields) == _filter_fields(_loads(data), fields)
+    assert type(_select_fields(data, ['score'])['score']) is float
+    null = bytearray(b"null")
+    assert _select_fields(null, ['tokens']) is None
+    assert _filter_fields(_loads(null), ['tokens']) is None
+
+def test_socket_deadlines():
+    # no java needed: the other end of a socketpair plays the server
+    a, b = socket.socketpair()
+    _set_buffer_sizes(a)
+    # nothing to read
+    t = time.time()
+    with_timeout = _socket_readinto(a, time.time() + 0.2)
+    try:
+        with_timeout(memoryview(bytearray(10)))
+        assert False, "should have timed out"
+    except socket.timeout:
+        assert time.time() - t < 1
+    # part of it arrives: returned, then the deadline runs out
+    b.sendall(b"12345")
+    buf = bytearray(10)
+    readinto = _socket_readinto(a, time.time() + 0.2)
+    assert readinto(memoryview(buf)) == 5
+    try:
+        _readinto_fully(memoryview(buf)[5:], readinto)
+        assert False, "should have timed out"
+    except socket.timeout:
+        pass
+    # all of it there: one recv
+    payload = b"x" * 100000
+    b.sendall(payload)
+    buf = bytearray(len(payload))
+    assert _socket_readinto(a, time.time() + 5)(memoryview(buf)) == len(payload)
+    assert _socket_readinto(a, None)
+    # the server isn't reading, and the buffers fill up
+    t = time.time()
+    try:
+        _send_before(a, b"y" * (64 << 20), time.time() + 0.2)
+        assert False, "should have timed out"
+    except socket.timeout:
+        assert time.time() - t < 1
+    a.close()
+    b.close()
+
 def test_paths():
     import pytest
     with pytest.raises(AssertionError):